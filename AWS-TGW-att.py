@@ -25,29 +25,96 @@ Updated on 25/03/21. Changes:
 """
 
 import boto3
+import collections
+import concurrent.futures
 import json
 import logging
 import urllib3
 import os
+import re
 import time
-
-EC2_CLIENT = boto3.client('ec2')
-IAM_CLIENT = boto3.client('iam')
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# boto3 clients are thread-safe, so a single client is shared by the worker threads below.
+# The connection pool is sized above MAX_WORKERS so threads don't queue on connections, and
+# adaptive retries absorb EC2 throttling during bursts of describe calls. The client is kept
+# at module scope so warm Lambda containers reuse the open connections.
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'max_attempts': 10, 'mode': 'adaptive'}
+)
+EC2_CLIENT = boto3.client('ec2', config=CLIENT_CONFIG)
+IAM_CLIENT = boto3.client('iam', config=CLIENT_CONFIG)
+
+# Reused across warm invocations for the CloudFormation response PUT.
+HTTP = urllib3.PoolManager(maxsize=10, retries=urllib3.Retry(total=3, backoff_factor=0.2))
+
+# Compact encoder for the CloudFormation response body; default=str covers values
+# such as datetimes that may end up in response_data.
+_ENCODE = json.JSONEncoder(separators=(',', ':'), default=str).encode
+
+MAX_WORKERS = 16
+
+# Mutating EC2 calls draw from a smaller token bucket than describe calls, so route
+# creation uses fewer workers and leans on adaptive retries to pace itself.
+MUTATING_MAX_WORKERS = 8
+
+# Largest page size accepted by DescribeVpcs and DescribeSubnets.
+# DescribeRouteTables caps MaxResults at 100.
+PAGE_SIZE = 1000
+ROUTE_TABLE_PAGE_SIZE = 100
+
+# Upper bounds for polling new transit gateway attachments until they become available.
+ATTACHMENT_MAX_WAIT = 300
+ATTACHMENT_MAX_BACKOFF = 15
+
+# Seconds of the function timeout kept back after polling, to create the routes and
+# send the CloudFormation response.
+ATTACHMENT_TIMEOUT_MARGIN = 30
+
+# Every attachment state except deleted. EC2 reports DuplicateTransitGatewayAttachment for
+# any of these, so the existing attachment is looked up in all of them.
+ATTACHMENT_EXISTING_STATES = [
+    'initiating', 'initiatingRequest', 'pendingAcceptance', 'rollingBack', 'pending',
+    'available', 'modifying', 'deleting', 'failed', 'failing', 'rejected', 'rejecting'
+]
+
+# States an attachment won't leave on its own. pendingAcceptance needs the transit gateway
+# owner to accept the attachment when auto-accept is off.
+ATTACHMENT_STUCK_STATES = frozenset(
+    ['pendingAcceptance', 'rejected', 'rejecting', 'failed', 'failing', 'deleted', 'deleting']
+)
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+SERVICE_ROLE_NAME = 'AWSServiceRoleForVPCTransitGateway'
+
+# The service-linked role is account wide and never removed by this function,
+# so warm containers only need to check for it once.
+_SERVICE_ROLE_CHECKED = False
+
+# Echo the CloudFormation response URL and body to stdout when troubleshooting.
+DEBUG_EVENTS = os.environ.get('DEBUG_EVENTS', '').lower() == 'true'
+
+# Environment variables are fixed for the life of the container, so resolve the level once.
+_LOG_LEVELS = {'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
+_LOG_LEVEL = _LOG_LEVELS.get(os.environ.get('logging_level', 'ERROR').upper())
+
+VPC_TAG_SEPARATOR = re.compile(r'\s*,\s*')
+
 
 def lambda_handler(event, context):
     response_data = {}
     setup_logging()
     log.info('In Main Handler')
-    log.info(json.dumps(event))
-    print(json.dumps(event))
+    if log.isEnabledFor(logging.INFO):
+        log.info('event=%s', json.dumps(event, separators=(',', ':')))
 
     account = event['ResourceProperties']['Account']
     region = event['ResourceProperties']['Region']
-    vpc_tags = event['ResourceProperties']['Vpc_Tags']
+    vpc_tags = VPC_TAG_SEPARATOR.split(event['ResourceProperties']['Vpc_Tags'].strip())
     # CIDR has now been changed to a list to allow us to pass in a string of CIDrs that we care about.
     # Subsequent calls that use CIDR will use this LIST and loop through each item in teh list
     cidr = (event['ResourceProperties']['CIDR']).split(
@@ -57,10 +124,18 @@ def lambda_handler(event, context):
     if event['RequestType'] in ['Update', 'Create']:
         log.info('Event = ' + event['RequestType'])
 
-        create_service_link_role()
-        vpc_metadata = get_vpc_metadata(account, region, vpc_tags, cidr)
-        create_transit_gateways(vpc_metadata, tgw_id)
-        create_vpc_route_to_tgw(vpc_metadata, tgw_id, cidr)
+        try:
+            create_service_link_role()
+            vpc_metadata = get_vpc_metadata(account, region, vpc_tags)
+            create_transit_gateways(vpc_metadata, tgw_id, context)
+            create_vpc_route_to_tgw(vpc_metadata, tgw_id, cidr)
+        except Exception:
+            # Tell CloudFormation straight away so the stack rolls back instead of waiting
+            # for the custom resource to time out. Don't re-raise: CloudFormation invokes
+            # the function asynchronously, so Lambda would retry against a rolling-back stack.
+            log.exception('Failed to attach VPCs to ' + tgw_id)
+            send(event, context, 'FAILED', response_data)
+            return
 
         send(event, context, 'SUCCESS', response_data)
 
@@ -76,218 +151,331 @@ def lambda_handler(event, context):
 
 def create_vpc_route_to_tgw(vpc_metadata, tgw_id, cidr: list):
     response_data = {}
+    cidr_set = frozenset(cidr)
+    jobs = []
 
     for entry in vpc_metadata:
-        if entry['Subnet']:
-            try:
-                describe_routes = EC2_CLIENT.describe_route_tables(
-                    RouteTableIds=entry['Route_Tables'],
-                )
-
-                describe_routes = describe_routes['RouteTables']
-
-                for rt in describe_routes:
-                    for route in rt['Routes']:
-                        if "DestinationCidrBlock" in route:
-                            if route['DestinationCidrBlock'] == cidr:
-                                EC2_CLIENT.delete_route(
-                                    DestinationCidrBlock=cidr,
-                                    RouteTableId=rt["RouteTableId"]
-                                )
-                    for block in cidr:
-                        EC2_CLIENT.create_route(
-                            RouteTableId=rt["RouteTableId"],
-                            DestinationCidrBlock=block,
-                            TransitGatewayId=tgw_id
-                        )
-                        log.error('CREATED ROUTE to ' + block + ' for ' + rt["RouteTableId"] +
-                                  ' with a destination of ' + tgw_id)
-
-            except Exception as e:
-                log.error(e)
-                return None
-
-
-def create_transit_gateways(vpc_metadata, tgw_id):
-    for entry in vpc_metadata:
-        if entry['Subnet']:
-            try:
-                response = EC2_CLIENT.create_transit_gateway_vpc_attachment(
-                    TransitGatewayId=tgw_id,
-                    VpcId=entry['Vpc'],
-                    SubnetIds=entry['Subnet'],
-                )
-
-            except Exception as e:
-                log.error(e)
-                return None
-        else:
-            print('No subnets in VPC,' + entry['Vpc'] + ' unable to attach VPC')
-
-    time.sleep(90)
-
-
-def get_vpc_metadata(account, region, vpc_tags, cidr):
-    vpc_tags = vpc_tags.replace(' ', '')
-    vpc_tags = vpc_tags.split(',')
+        # An empty RouteTableIds list would describe every route table in the region.
+        if entry['Subnet'] and entry['Route_Tables']:
+            describe_routes = EC2_CLIENT.describe_route_tables(
+                RouteTableIds=entry['Route_Tables'],
+            )
 
-    returned_metadata = []
+            describe_routes = describe_routes['RouteTables']
 
-    for tag in vpc_tags:
+            for rt in describe_routes:
+                # Routes for our blocks that already target this transit gateway are kept,
+                # any other route for one of our blocks is retargeted in place so traffic
+                # is never left without a route.
+                existing = set()
+                for route in rt['Routes']:
+                    if route.get('DestinationCidrBlock') in cidr_set:
+                        existing.add(route['DestinationCidrBlock'])
+                        if route.get('TransitGatewayId') != tgw_id:
+                            jobs.append(
+                                ('replace_route', rt["RouteTableId"], route['DestinationCidrBlock']))
+                for block in cidr_set - existing:
+                    jobs.append(('create_route', rt["RouteTableId"], block))
+
+    def route_to_tgw(job):
+        action, route_table, block = job
         try:
-            get_vpc_response = EC2_CLIENT.describe_vpcs()
-            for vpc in get_vpc_response['Vpcs']:
-                if 'Tags' in vpc:
-                    for tag_value in vpc['Tags']:
-                        if tag_value['Value'] == tag:
-                            metadata = {}
-                            returned_vpc = vpc['VpcId']
-                            subnets = get_subnets(returned_vpc)
-                            route_tables = get_default_route_table(returned_vpc, cidr, vpc_tag="True")
-                            metadata['Vpc'] = returned_vpc
-                            metadata['Subnet'] = subnets
-                            metadata['Route_Tables'] = route_tables
-                            returned_metadata.append(metadata)
-
-        except Exception as e:
-            log.error(e)
-            return None
-
-    return returned_metadata
-
-
-def get_subnets(returned_vpc, vpc_tag="True"):
-    subnet_list = []
-    az_subnet_mapping = []
-
-    try:
-        get_subnet_response = EC2_CLIENT.describe_subnets(
-            Filters=[
-                {
-                    'Name': 'vpc-id',
-                    'Values': [returned_vpc]
-                },
-                {
-                    'Name': 'tag:tgw-attach',
-                    'Values': [vpc_tag]
-                }
-            ])
-
-        for entry in get_subnet_response['Subnets']:
-            subnet_list.append(entry['SubnetId'])
-
-        for subnet in subnet_list:
-            response = EC2_CLIENT.describe_subnets(
-                Filters=[
-                    {
-                        'Name': 'subnet-id',
-                        'Values': [subnet]
-                    },
-                ],
+            getattr(EC2_CLIENT, action)(
+                RouteTableId=route_table,
+                DestinationCidrBlock=block,
+                TransitGatewayId=tgw_id
             )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'RouteAlreadyExists':
+                log.info('Route to ' + block + ' already exists for ' + route_table)
+                return job, None
+            return job, e
+        except BotoCoreError as e:
+            # Connection errors and read timeouts that outlast the retries.
+            return job, e
+        verb = 'REPLACED' if action == 'replace_route' else 'CREATED'
+        log.error(verb + ' ROUTE to ' + block + ' for ' + route_table +
+                  ' with a destination of ' + tgw_id)
+        return job, None
+
+    # Every (route table, block) pair is independent, so route them concurrently and
+    # report all failures rather than stopping at the first one.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MUTATING_MAX_WORKERS) as executor:
+        results = list(executor.map(route_to_tgw, jobs))
+
+    failed = [(job, e) for job, e in results if e is not None]
+    for (action, route_table, block), e in failed:
+        log.error('Failed to route ' + block + ' for ' + route_table + ' to ' + tgw_id
+                  + ': ' + str(e))
+    log.info('Routed ' + str(len(results) - len(failed)) + ' of ' + str(len(results))
+             + ' blocks to ' + tgw_id)
+
+    if failed:
+        raise RuntimeError(str(len(failed)) + ' of ' + str(len(results)) + ' routes to '
+                           + tgw_id + ' could not be created or replaced')
+
+
+def create_transit_gateways(vpc_metadata, tgw_id, context):
+    # Attachments are independent, so create them concurrently and wait for them together.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MUTATING_MAX_WORKERS) as executor:
+        futures = {}
+        for entry in vpc_metadata:
+            if entry['Subnet']:
+                futures[entry['Vpc']] = executor.submit(
+                    attach_vpc, tgw_id, entry['Vpc'], entry['Subnet'])
+            else:
+                print('No subnets in VPC,' + entry['Vpc'] + ' unable to attach VPC')
+
+    # Collect every outcome before raising so attachments that were created are still reported.
+    attachment_ids = []
+    failed = []
+    for vpc_id, future in futures.items():
+        try:
+            attachment_ids.append(future.result())
+        except Exception as e:
+            failed.append((vpc_id, e))
 
-            for sub in response['Subnets']:
-                if not any(sub['AvailabilityZone'] in az for az in az_subnet_mapping):
-                    az_subnet_mapping.append({
-                        sub['AvailabilityZone']: sub['SubnetId']
-                    })
-
-    except Exception as e:
-        log.error(e)
-        return None
-
-    subnets = []
+    if attachment_ids:
+        log.info('Transit gateway attachments for ' + tgw_id + ': ' + ', '.join(attachment_ids))
+    for vpc_id, e in failed:
+        log.error('Failed to attach ' + vpc_id + ' to ' + tgw_id + ': ' + str(e))
 
-    for subnet_mapping in az_subnet_mapping:
-        for key, value in subnet_mapping.items():
-            subnets.append(value)
+    if failed:
+        raise RuntimeError(str(len(failed)) + ' of ' + str(len(futures)) + ' VPCs could not be '
+                           'attached to ' + tgw_id)
 
-    return subnets
+    wait_for_attachments(attachment_ids, context)
 
 
-def get_default_route_table(returned_vpc, cidr, vpc_tag="True"):
+def attach_vpc(tgw_id, vpc_id, subnet_ids):
     try:
-        describe_route_tables = EC2_CLIENT.describe_route_tables(
+        response = EC2_CLIENT.create_transit_gateway_vpc_attachment(
+            TransitGatewayId=tgw_id,
+            VpcId=vpc_id,
+            SubnetIds=subnet_ids,
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'DuplicateTransitGatewayAttachment':
+            raise
+        # On Update the VPC is usually attached already, so reuse that attachment.
+        response = EC2_CLIENT.describe_transit_gateway_vpc_attachments(
             Filters=[
                 {
-                    'Name': 'vpc-id',
-                    'Values': [returned_vpc]
+                    'Name': 'transit-gateway-id',
+                    'Values': [tgw_id]
                 },
                 {
-                    'Name': 'association.main',
-                    'Values': ['false']
-
+                    'Name': 'vpc-id',
+                    'Values': [vpc_id]
                 },
                 {
-                    'Name': 'tag:tgw-attach',
-                    'Values': [vpc_tag]
+                    'Name': 'state',
+                    'Values': ATTACHMENT_EXISTING_STATES
                 }
-
             ]
         )
+        # An attachment that is unusable (deleting, failed, rejected) is still returned here,
+        # so wait_for_attachments reports it as stuck by ID.
+        attachments = response['TransitGatewayVpcAttachments']
+        if not attachments:
+            raise RuntimeError('EC2 reported an existing attachment of ' + vpc_id + ' to '
+                               + tgw_id + ' but none was found')
+        attachment_id = attachments[0]['TransitGatewayAttachmentId']
+        log.info(vpc_id + ' is already attached to ' + tgw_id + ' as ' + attachment_id)
+        return attachment_id
+
+    return response['TransitGatewayVpcAttachment']['TransitGatewayAttachmentId']
+
+
+def wait_for_attachments(attachment_ids, context):
+    # Routes can only target the transit gateway once its attachments are available,
+    # so poll with exponential backoff instead of sleeping for the worst case.
+    if not attachment_ids:
+        return
+
+    # Stop early enough that Lambda doesn't kill the function before CloudFormation hears back.
+    remaining_budget = context.get_remaining_time_in_millis() / 1000 - ATTACHMENT_TIMEOUT_MARGIN
+    deadline = time.monotonic() + min(ATTACHMENT_MAX_WAIT, remaining_budget)
+    attempt = 0
+
+    while True:
+        # EC2 is eventually consistent, so attachments created moments ago may not be
+        # visible yet. Those are treated as still pending until the deadline.
+        try:
+            response = EC2_CLIENT.describe_transit_gateway_vpc_attachments(
+                TransitGatewayAttachmentIds=attachment_ids,
+            )
+            attachments = response['TransitGatewayVpcAttachments']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidTransitGatewayAttachmentID.NotFound':
+                raise
+            attachments = []
+
+        states = dict.fromkeys(attachment_ids, 'notFound')
+        for attachment in attachments:
+            states[attachment['TransitGatewayAttachmentId']] = attachment['State']
+
+        if all(state == 'available' for state in states.values()):
+            log.info('Transit gateway attachments available: ' + ', '.join(attachment_ids))
+            return
+
+        stuck = [
+            attachment_id + '=' + state for attachment_id, state in states.items()
+            if state in ATTACHMENT_STUCK_STATES
+        ]
+        if stuck:
+            raise RuntimeError('Transit gateway attachments will not become available: '
+                               + ', '.join(stuck))
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError('Timed out waiting for transit gateway attachments: '
+                               + ', '.join(k + '=' + v for k, v in states.items()))
+
+        time.sleep(min(2 ** attempt, ATTACHMENT_MAX_BACKOFF, remaining))
+        attempt += 1
+
+
+def get_vpc_metadata(account, region, vpc_tags: list):
+    vpc_ids = []
+
+    # Let EC2 select the VPCs carrying any of our tag values, then index the result by
+    # tag value so the VPCs are still returned in the order the tags were given.
+    paginator = EC2_CLIENT.get_paginator('describe_vpcs')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'tag-value',
+                'Values': vpc_tags
+            }
+        ],
+        PaginationConfig={'PageSize': PAGE_SIZE}
+    )
+    tag_to_vpcs = collections.defaultdict(list)
+    for page in pages:
+        for vpc in page['Vpcs']:
+            for tag_value in vpc.get('Tags', ()):
+                tag_to_vpcs[tag_value['Value']].append(vpc['VpcId'])
 
-        route_table_ids = [rt['RouteTableId'] for rt in describe_route_tables['RouteTables']]
+    for tag in vpc_tags:
+        vpc_ids.extend(tag_to_vpcs.get(tag, ()))
 
-        for route_table in route_table_ids:
-            describe_routes = EC2_CLIENT.describe_route_tables(
-                RouteTableIds=[
-                    route_table,
-                ],
-            )
-            describe_routes = describe_routes['RouteTables']
+    # A VPC matching several tags or values must still only be attached once.
+    vpc_ids = list(dict.fromkeys(vpc_ids))
 
-            for route in describe_routes[0]['Routes']:
-                if "DestinationCidrBlock" in route:
-                    for block in cidr:
-                        if route['DestinationCidrBlock'] == cidr:
-                            EC2_CLIENT.delete_route(
-                                DestinationCidrBlock=block,
-                                RouteTableId=route_table
-                            )
+    def describe_vpc(returned_vpc):
+        metadata = {}
+        metadata['Vpc'] = returned_vpc
+        metadata['Subnet'] = get_subnets(returned_vpc)
+        metadata['Route_Tables'] = get_default_route_table(returned_vpc, vpc_tag="True")
+        return metadata
 
-    except Exception as e:
-        log.error(e)
-        return None
+    # The subnet and route table lookups are independent per VPC, so fan them out.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        returned_metadata = list(executor.map(describe_vpc, vpc_ids))
 
-    return route_table_ids
+    return returned_metadata
 
 
-def create_service_link_role():
-    service_role_exists = False
+def get_subnets(returned_vpc, vpc_tag="True"):
+    # Transit gateway attachments take at most one subnet per availability zone.
+    # The vpc-id describe already returns each subnet's AZ, so no per-subnet lookup is needed.
+    az_to_subnet = {}
+
+    paginator = EC2_CLIENT.get_paginator('describe_subnets')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'vpc-id',
+                'Values': [returned_vpc]
+            },
+            {
+                'Name': 'tag:tgw-attach',
+                'Values': [vpc_tag]
+            }
+        ],
+        PaginationConfig={'PageSize': PAGE_SIZE}
+    )
 
-    list_roles = IAM_CLIENT.list_roles(
+    for page in pages:
+        for entry in page['Subnets']:
+            if entry['AvailabilityZone'] not in az_to_subnet:
+                az_to_subnet[entry['AvailabilityZone']] = entry['SubnetId']
+
+    return list(az_to_subnet.values())
+
+
+def get_default_route_table(returned_vpc, vpc_tag="True"):
+    paginator = EC2_CLIENT.get_paginator('describe_route_tables')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'vpc-id',
+                'Values': [returned_vpc]
+            },
+            {
+                'Name': 'association.main',
+                'Values': ['false']
+
+            },
+            {
+                'Name': 'tag:tgw-attach',
+                'Values': [vpc_tag]
+            }
+
+        ],
+        PaginationConfig={'PageSize': ROUTE_TABLE_PAGE_SIZE}
     )
 
-    for role in list_roles['Roles']:
-        if role['RoleName'] == 'AWSServiceRoleForVPCTransitGateway':
-            service_role_exists = True
+    # Only the IDs are collected here; create_vpc_route_to_tgw replaces any of our routes
+    # that don't already target the transit gateway once the attachments exist.
+    return [rt['RouteTableId'] for page in pages for rt in page['RouteTables']]
 
-    if not service_role_exists:
-        create_role = IAM_CLIENT.create_service_linked_role(
-            AWSServiceName='transitgateway.amazonaws.com',
-        )
-        print(create_role)
 
+def create_service_link_role():
+    global _SERVICE_ROLE_CHECKED
+    if _SERVICE_ROLE_CHECKED:
+        return ()
+
+    try:
+        IAM_CLIENT.get_role(RoleName=SERVICE_ROLE_NAME)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        try:
+            create_role = IAM_CLIENT.create_service_linked_role(
+                AWSServiceName='transitgateway.amazonaws.com',
+            )
+            print(create_role)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidInput':
+                raise
+            # Another stack may have created the role since get_role; the second get_role
+            # raises NoSuchEntity again if it really is missing.
+            IAM_CLIENT.get_role(RoleName=SERVICE_ROLE_NAME)
+            log.info(SERVICE_ROLE_NAME + ' was created concurrently')
+
+    _SERVICE_ROLE_CHECKED = True
     return ()
 
 
 def setup_logging():
     """Setup Logging."""
     global log
+    # The root logger outlives the invocation, so warm containers keep the earlier setup.
+    if 'log' in globals() and log.handlers:
+        return
+
     log = logging.getLogger()
-    log_levels = {'INFO': 20, 'WARNING': 30, 'ERROR': 40}
-
-    if 'logging_level' in os.environ:
-        log_level = os.environ['logging_level'].upper()
-        if log_level in log_levels:
-            log.setLevel(log_levels[log_level])
-        else:
-            log.setLevel(log_levels['ERROR'])
-            log.error("The logging_level environment variable is not set \
-                      to INFO, WARNING, or ERROR. \
-                      The log level is set to ERROR")
+
+    if _LOG_LEVEL is not None:
+        log.setLevel(_LOG_LEVEL)
     else:
-        log.setLevel(log_levels['ERROR'])
+        log.setLevel(logging.ERROR)
+        log.error("The logging_level environment variable is not set \
+                  to INFO, WARNING, or ERROR. \
+                  The log level is set to ERROR")
+    if 'logging_level' not in os.environ:
         log.warning('The logging_level environment variable is not set.')
         log.warning('Setting the log level to ERROR')
     log.info('Logging setup complete - set to log level '
@@ -297,7 +485,8 @@ def setup_logging():
 def send(event, context, responseStatus, response_data, physicalResourceId=None, noEcho=False):
     responseUrl = event['ResponseURL']
 
-    print(responseUrl)
+    if DEBUG_EVENTS:
+        print(responseUrl)
 
     responseBody = {}
     responseBody['Status'] = responseStatus
@@ -310,9 +499,10 @@ def send(event, context, responseStatus, response_data, physicalResourceId=None,
     responseBody['NoEcho'] = noEcho
     responseBody['Data'] = response_data
 
-    json_responseBody = json.dumps(responseBody)
+    json_responseBody = _ENCODE(responseBody)
 
-    print("Response body:\n" + json_responseBody)
+    if DEBUG_EVENTS:
+        print("Response body:\n" + json_responseBody)
 
     headers = {
         'content-type': '',
@@ -320,8 +510,7 @@ def send(event, context, responseStatus, response_data, physicalResourceId=None,
     }
 
     try:
-        http = urllib3.PoolManager()
-        response = http.request("PUT", responseUrl, headers=headers, body=json_responseBody)
+        response = HTTP.request("PUT", responseUrl, headers=headers, body=json_responseBody)
         print("Status code:" + response.reason)
 
     except Exception as e: